@@ -0,0 +1,30 @@
+import multiprocessing
+
+bind = "0.0.0.0:8000"
+workers = multiprocessing.cpu_count()
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import the app (and load the summarizer weights) once in the master
+# process before forking, so copy-on-write shares the read-only weight
+# pages across all workers instead of each one holding its own copy.
+preload_app = True
+
+
+def _cuda_available():
+    import torch
+    return torch.cuda.is_available()
+
+
+def on_starting(server):
+    # A CUDA context created in the master does not survive fork, so the
+    # pre-fork copy-on-write load only applies to CPU-only hosts; GPU
+    # hosts load the model per worker in post_fork instead.
+    if not _cuda_available():
+        from plsnb import get_summarizer
+        get_summarizer()
+
+
+def post_fork(server, worker):
+    if _cuda_available():
+        from plsnb import get_summarizer
+        get_summarizer()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, ForeignKey, DateTime, func
+from sqlalchemy import Column, String, ForeignKey, DateTime, func, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 import uuid
@@ -7,9 +7,15 @@ from database import Base
 
 class Note(Base):
     __tablename__ = "notes"
+    __table_args__ = (
+        # Title lookups are always per-user, so the composite index makes
+        # them point lookups and backs ON CONFLICT upserts of stub notes.
+        Index("ix_notes_user_title", "user_id", "title", unique=True),
+        Index("ix_notes_user_id", "user_id"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4)
-    title = Column(String, index=True)
+    title = Column(String)
     content = Column(String)
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -1,174 +1,473 @@
-from fastapi import FastAPI, Depends, HTTPException, Body
-from sqlalchemy.orm import Session
-from uuid import UUID, uuid4
-from typing import List, Optional
-import redis
-import json
-from datetime import datetime
-
-from database import get_db, engine
-import models
-from models import Note, User as DBUser
-import schemas
-from schemas import NoteCreate
-from utils import extract_links
-
-from fastapi.middleware.cors import CORSMiddleware
-from transformers import pipeline
-
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-summarizer = pipeline("summarization", model="sshleifer/distilbart-cnn-12-6")
-models.Base.metadata.create_all(bind=engine)
-
-redis_client = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
-
-
-def safe_serialize(list_of_dicts):
-    converted = []
-    for item in list_of_dicts:
-        clean = {}
-        for k, v in item.items():
-            if isinstance(v, UUID):
-                clean[k] = str(v)
-            elif isinstance(v, datetime):
-                clean[k] = v.isoformat()
-            else:
-                clean[k] = v
-        converted.append(clean)
-    return converted
-
-
-def upsert_stub_notes(db: Session, user_id: UUID, linked_titles: list[str]):
-    for title in linked_titles:
-        title = title.strip()
-        if not title:
-            continue
-        existing = (
-            db.query(Note)
-            .filter(Note.user_id == user_id, Note.title == title)
-            .first()
-        )
-        if existing is None:
-            stub = Note(
-                id=uuid4(),
-                title=title,
-                content="",
-                user_id=user_id,
-            )
-            db.add(stub)
-    db.commit()
-
-
-def process_links_for_note(db: Session, note: Note):
-    linked_titles = extract_links(note.content)
-    if linked_titles:
-        upsert_stub_notes(db, note.user_id, linked_titles)
-
-
-@app.get("/", tags=["Root"])
-def root():
-    return {"message": "Welcome to the open Notetaker API!"}
-
-
-@app.get("/notes", response_model=List[schemas.Note], tags=["Notes"])
-def get_notes(db: Session = Depends(get_db)):
-    notes = db.query(Note).all()
-    result = [schemas.Note.model_validate(n).model_dump() for n in notes]
-    return result
-
-
-@app.post("/notes/", response_model=schemas.Note, tags=["Notes"])
-def create_note(note_in: NoteCreate, db: Session = Depends(get_db)):
-    # Default: use a dummy user_id since auth is removed
-    dummy_user = db.query(DBUser).first()
-    if not dummy_user:
-        dummy_user = DBUser(id=uuid4(), username="agent")
-        db.add(dummy_user)
-        db.commit()
-        db.refresh(dummy_user)
-
-    db_note = Note(**note_in.model_dump(), user_id=dummy_user.id)
-    db.add(db_note)
-    db.commit()
-    db.refresh(db_note)
-
-    process_links_for_note(db, db_note)
-    return db_note
-
-
-@app.put("/notes/{note_id}", response_model=schemas.Note, tags=["Notes"])
-def update_note(note_id: UUID, note_in: NoteCreate, db: Session = Depends(get_db)):
-    note = db.query(Note).filter(Note.id == note_id).first()
-    if not note:
-        raise HTTPException(404, "Note not found")
-
-    note.title = note_in.title
-    note.content = note_in.content
-    db.commit()
-    db.refresh(note)
-
-    process_links_for_note(db, note)
-    return note
-
-
-@app.get("/notes/{note_id}/with_links", tags=["Notes"])
-def get_note_with_links(note_id: UUID, db: Session = Depends(get_db)):
-    note = db.query(Note).filter(Note.id == note_id).first()
-    if not note:
-        raise HTTPException(404, "Note not found")
-
-    out_titles = extract_links(note.content)
-    outgoing = (
-        db.query(Note)
-        .filter(Note.title.in_(out_titles))
-        .all()
-        if out_titles else []
-    )
-
-    backlinks = []
-    candidates = db.query(Note).filter(Note.id != note.id).all()
-    for cand in candidates:
-        if note.title in extract_links(cand.content):
-            backlinks.append(cand)
-
-    return {
-        "note": schemas.Note.model_validate(note),
-        "outgoing_links": [schemas.Note.model_validate(n) for n in outgoing],
-        "backlinks": [schemas.Note.model_validate(n) for n in backlinks],
-    }
-
-
-@app.post("/summarize/", tags=["AI"])
-def summarize(content: Optional[str] = Body(None, embed=True), db: Session = Depends(get_db)):
-    if not content:
-        raise HTTPException(400, "Content must be provided")
-
-    def chunk_text(text, max_len=500):
-        import re
-        sentences = re.split(r'(?<=[.!?]) +', text)
-        cur, out = "", []
-        for s in sentences:
-            if len(cur) + len(s) + 1 <= max_len:
-                cur += (" " if cur else "") + s
-            else:
-                out.append(cur)
-                cur = s
-        if cur:
-            out.append(cur)
-        return out
-
-    chunks = chunk_text(content, 500)
-    partial = [summarizer(c, max_length=100, min_length=30, do_sample=False)[0]["summary_text"] for c in chunks]
-    final = " ".join(partial) if len(partial) == 1 else summarizer(" ".join(partial), max_length=120, min_length=30, do_sample=False)[0]["summary_text"]
-    return {"summary": final}
-
-
+from fastapi import FastAPI, Depends, HTTPException, Body, BackgroundTasks, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from pydantic import TypeAdapter
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from uuid import UUID, uuid4
+from typing import List, Optional
+from contextlib import suppress
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import asyncpg
+import redis.asyncio as redis
+import zstandard
+
+from database import get_db, engine, DATABASE_URL
+import models
+from models import Note, User as DBUser
+import schemas
+from schemas import NoteCreate
+from utils import extract_links
+
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from transformers import pipeline
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+SUMMARIZER_MODEL = "sshleifer/distilbart-cnn-12-6"
+
+
+def _build_summarizer():
+    # Prefer an INT8 ONNX export (optimum-cli export onnx + onnxruntime
+    # quantize) if one is available; otherwise run FP16 on the GPU when
+    # there is one, and fall back to the stock checkpoint with dynamic
+    # INT8 quantization of the Linear layers on CPU.
+    onnx_dir = os.getenv("SUMMARIZER_ONNX_DIR")
+    if onnx_dir:
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        from transformers import AutoTokenizer
+
+        model = ORTModelForSeq2SeqLM.from_pretrained(onnx_dir)
+        tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+        return pipeline("summarization", model=model, tokenizer=tokenizer)
+
+    import torch
+
+    if torch.cuda.is_available():
+        return pipeline(
+            "summarization", model=SUMMARIZER_MODEL,
+            device=0, torch_dtype=torch.float16,
+        )
+
+    sm = pipeline("summarization", model=SUMMARIZER_MODEL)
+    sm.model = torch.quantization.quantize_dynamic(
+        sm.model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return sm
+
+
+_summarizer = None
+_summarizer_lock = threading.Lock()
+
+
+def get_summarizer():
+    # Loading the weights at import made every worker pay ~10s of cold
+    # start (and ~400MB of RSS) before serving its first request, AI or
+    # not. Defer to the first /summarize/ call, double-checked under a
+    # lock so concurrent first calls load the model only once.
+    global _summarizer
+    if _summarizer is None:
+        with _summarizer_lock:
+            if _summarizer is None:
+                _summarizer = _build_summarizer()
+    return _summarizer
+
+# No decode_responses: cached payloads stay bytes so they can be handed
+# to Response without a decode/re-encode round trip.
+redis_client = redis.Redis(host="localhost", port=6379, db=0)
+
+NOTES_CACHE_KEY = "notes_all"
+NOTES_LOCK_KEY = NOTES_CACHE_KEY + ":lock"
+
+# Populate the cache only if the dogpile lease still holds our token.
+# Every invalidation path deletes the lock key along with the cache key,
+# so a write that lands between a reader's SELECT and its post-response
+# SET revokes the lease and the stale payload is dropped, not stored.
+_store_if_leased = redis_client.register_script(
+    """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+        redis.call('DEL', KEYS[1])
+        return 1
+    end
+    return 0
+    """
+)
+
+# Release the lease only if it is still ours.
+_release_lease = redis_client.register_script(
+    """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        redis.call('DEL', KEYS[1])
+        return 1
+    end
+    return 0
+    """
+)
+
+_zstd_compress = zstandard.ZstdCompressor(level=3).compress
+_zstd_decompress = zstandard.ZstdDecompressor().decompress
+
+
+def _accepts_zstd(request: Request) -> bool:
+    # Match Accept-Encoding tokens, not substrings: "zstd;q=0" is a
+    # refusal, and e.g. "x-zstd" must not count as acceptance.
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() != "zstd":
+            continue
+        params = params.replace(" ", "").lower()
+        if params.startswith("q="):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def _notes_response(compressed: bytes, request: Request) -> Response:
+    # Serve the zstd frame as-is to clients that accept it; decompress
+    # for the rest. Either way the body depends on Accept-Encoding, so
+    # caches must key on it.
+    if _accepts_zstd(request):
+        return Response(
+            content=compressed,
+            media_type="application/json",
+            headers={"Content-Encoding": "zstd", "Vary": "Accept-Encoding"},
+        )
+    return Response(
+        content=_zstd_decompress(compressed),
+        media_type="application/json",
+        headers={"Vary": "Accept-Encoding"},
+    )
+
+_SENT_SPLIT = re.compile(r"(?<=[.!?]) +")
+
+
+def chunk_text(text: str, max_len: int = 500) -> list[str]:
+    sentences = _SENT_SPLIT.split(text)
+    out: list[str] = []
+    buf: list[str] = []
+    size = 0
+    for s in sentences:
+        if size + len(s) + 1 <= max_len:
+            buf.append(s)
+            size += len(s) + 1
+        else:
+            if buf:
+                out.append(" ".join(buf))
+            buf = [s]
+            size = len(s) + 1
+    if buf:
+        out.append(" ".join(buf))
+    return out
+
+
+async def invalidate_many(keys: list[str]):
+    # One round trip for N keys instead of N DELETEs. The lock key goes
+    # too, revoking any in-flight repopulate of a now-stale payload.
+    pipe = redis_client.pipeline(transaction=False)
+    for k in keys:
+        pipe.delete(k, k + ":lock")
+    await pipe.execute()
+
+
+async def invalidate_notes_cache():
+    await redis_client.delete(NOTES_CACHE_KEY, NOTES_LOCK_KEY)
+
+
+async def _store_notes_cache(payload: bytes, token: str):
+    # Runs after the response has flushed: compress and populate the
+    # cache without the client waiting on Redis. The SET is conditional
+    # on the lease so an invalidation that raced us wins; with that in
+    # place the long TTL is just a backstop for NOTIFY invalidation.
+    await _store_if_leased(
+        keys=[NOTES_LOCK_KEY, NOTES_CACHE_KEY],
+        args=[token, _zstd_compress(payload), 3600],
+    )
+
+
+@app.on_event("startup")
+async def init_db():
+    # create_all costs an information_schema round trip per worker boot
+    # and contends on pg_class when many workers start at once, so only
+    # dev opts in; production schemas are managed out of band.
+    if os.getenv("RUN_DDL") != "1":
+        return
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+        await conn.execute(text(
+            """
+            CREATE OR REPLACE FUNCTION notes_notify() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('notes_changed', COALESCE(NEW.user_id, OLD.user_id)::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """
+        ))
+        await conn.execute(text("DROP TRIGGER IF EXISTS notes_changed_trigger ON notes"))
+        await conn.execute(text(
+            """
+            CREATE TRIGGER notes_changed_trigger
+                AFTER INSERT OR UPDATE OR DELETE ON notes
+                FOR EACH ROW EXECUTE FUNCTION notes_notify()
+            """
+        ))
+
+
+# The loop only keeps weak references to tasks, so invalidation tasks
+# must be held here until done or they can be garbage-collected unrun.
+_invalidation_tasks: set[asyncio.Task] = set()
+
+
+def _on_notes_changed(conn, pid, channel, payload):
+    # payload is the user_id; with the single shared cache key, any
+    # change drops the whole entry (and the lease, revoking in-flight
+    # repopulates of the stale payload).
+    task = asyncio.create_task(redis_client.delete(NOTES_CACHE_KEY, NOTES_LOCK_KEY))
+    _invalidation_tasks.add(task)
+    task.add_done_callback(_invalidation_tasks.discard)
+
+
+async def _notify_listener():
+    # The 1h TTL is only safe while a LISTEN connection is attached, so
+    # the listener is supervised: reconnect on any connection loss, and
+    # drop the cache on every (re)connect to cover notifications missed
+    # while down.
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL.replace("+asyncpg", ""))
+            await conn.add_listener("notes_changed", _on_notes_changed)
+            await redis_client.delete(NOTES_CACHE_KEY, NOTES_LOCK_KEY)
+            while not conn.is_closed():
+                await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await asyncio.sleep(1)
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+
+
+@app.on_event("startup")
+async def start_notify_listener():
+    # Precise cross-worker invalidation: any write to notes — including
+    # ones that bypass this app — NOTIFYs, and the listener drops the
+    # Redis entry, so the cache TTL no longer bounds staleness.
+    app.state.notify_task = asyncio.create_task(_notify_listener())
+
+
+@app.on_event("shutdown")
+async def stop_notify_listener():
+    app.state.notify_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await app.state.notify_task
+
+
+# Serializes ORM rows straight to JSON bytes in pydantic-core (Rust),
+# handling UUID and datetime natively.
+_NOTES_ADAPTER = TypeAdapter(List[schemas.Note])
+
+
+async def upsert_stub_notes(db: AsyncSession, user_id: UUID, linked_titles: list[str]) -> set[str]:
+    titles = list(dict.fromkeys(t.strip() for t in linked_titles if t.strip()))
+    if not titles:
+        return set()
+
+    # One INSERT ... ON CONFLICT DO NOTHING for the whole batch: the
+    # (user_id, title) unique index turns the existence check into a
+    # conflict target, so no separate SELECT round trip is needed.
+    stmt = pg_insert(Note).values(
+        [
+            {"id": uuid4(), "title": t, "content": "", "user_id": user_id}
+            for t in titles
+        ]
+    ).on_conflict_do_nothing(index_elements=["user_id", "title"])
+    result = await db.execute(stmt)
+    await db.commit()
+    if result.rowcount:
+        return {NOTES_CACHE_KEY}
+    return set()
+
+
+async def process_links_for_note(db: AsyncSession, note: Note) -> set[str]:
+    linked_titles = extract_links(note.content)
+    if linked_titles:
+        return await upsert_stub_notes(db, note.user_id, linked_titles)
+    return set()
+
+
+@app.get("/", tags=["Root"])
+async def root():
+    return {"message": "Welcome to the open Notetaker API!"}
+
+
+@app.get("/notes", tags=["Notes"])
+async def get_notes(request: Request, bg: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    cached = await redis_client.get(NOTES_CACHE_KEY)
+    if cached:
+        # Cached value is the zstd-compressed JSON body; skip Pydantic
+        # re-validation and FastAPI re-encoding entirely.
+        return _notes_response(cached, request)
+
+    # Dogpile guard: on a cold key, only the lease holder queries Postgres;
+    # everyone else polls Redis briefly for the repopulated entry.
+    token = uuid4().hex
+    lease = await redis_client.set(NOTES_LOCK_KEY, token, nx=True, ex=5)
+    if not lease:
+        for _ in range(10):
+            await asyncio.sleep(0.05)
+            cached = await redis_client.get(NOTES_CACHE_KEY)
+            if cached:
+                return _notes_response(cached, request)
+        # Lease holder likely died; fall through and rebuild ourselves,
+        # but without a lease we serve only — no cache write.
+
+    try:
+        notes = (await db.execute(select(Note))).scalars().all()
+        payload = _NOTES_ADAPTER.dump_json(_NOTES_ADAPTER.validate_python(notes))
+    except Exception:
+        if lease:
+            await _release_lease(keys=[NOTES_LOCK_KEY], args=[token])
+        raise
+
+    if lease:
+        bg.add_task(_store_notes_cache, payload, token)
+    return Response(content=payload, media_type="application/json")
+
+
+@app.post("/notes/", response_model=schemas.Note, tags=["Notes"])
+async def create_note(note_in: NoteCreate, bg: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    # Default: use a dummy user_id since auth is removed
+    dummy_user = await db.scalar(select(DBUser))
+    if not dummy_user:
+        dummy_user = DBUser(id=uuid4(), username="agent")
+        db.add(dummy_user)
+        await db.commit()
+        await db.refresh(dummy_user)
+
+    # The (user_id, title) unique index means the title may already be
+    # taken — usually by an empty stub auto-created from a [[link]]. Fill
+    # the stub in place; a conflict with a real note is a 409, not a 500.
+    stmt = (
+        pg_insert(Note)
+        .values(id=uuid4(), **note_in.model_dump(), user_id=dummy_user.id)
+        .on_conflict_do_update(
+            index_elements=["user_id", "title"],
+            set_={"content": note_in.content, "updated_at": func.now()},
+            where=(Note.content == ""),
+        )
+        .returning(Note)
+    )
+    db_note = (await db.execute(stmt)).scalars().first()
+    if db_note is None:
+        await db.rollback()
+        raise HTTPException(409, "A note with this title already exists")
+    await db.commit()
+
+    stale_keys = {NOTES_CACHE_KEY}
+    stale_keys |= await process_links_for_note(db, db_note)
+    bg.add_task(invalidate_many, list(stale_keys))
+    return db_note
+
+
+@app.put("/notes/{note_id}", response_model=schemas.Note, tags=["Notes"])
+async def update_note(note_id: UUID, note_in: NoteCreate, bg: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    note = await db.scalar(select(Note).where(Note.id == note_id))
+    if not note:
+        raise HTTPException(404, "Note not found")
+
+    note.title = note_in.title
+    note.content = note_in.content
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Renamed onto a title the user already has.
+        await db.rollback()
+        raise HTTPException(409, "A note with this title already exists")
+    await db.refresh(note)
+
+    stale_keys = {NOTES_CACHE_KEY}
+    stale_keys |= await process_links_for_note(db, note)
+    bg.add_task(invalidate_many, list(stale_keys))
+    return note
+
+
+@app.get("/notes/{note_id}/with_links", tags=["Notes"])
+async def get_note_with_links(note_id: UUID, db: AsyncSession = Depends(get_db)):
+    note = await db.scalar(select(Note).where(Note.id == note_id))
+    if not note:
+        raise HTTPException(404, "Note not found")
+
+    out_titles = extract_links(note.content)
+    outgoing = (
+        (await db.execute(select(Note).where(Note.title.in_(out_titles)))).scalars().all()
+        if out_titles else []
+    )
+
+    # Let Postgres find referencing notes instead of regex-scanning every
+    # candidate in Python; only actual backlinks cross the wire.
+    pattern = "%[[" + note.title.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "]]%"
+    backlinks = (
+        await db.execute(
+            select(Note).where(
+                Note.id != note.id,
+                Note.content.like(pattern, escape="\\"),
+            )
+        )
+    ).scalars().all()
+
+    return {
+        "note": schemas.Note.model_validate(note),
+        "outgoing_links": [schemas.Note.model_validate(n) for n in outgoing],
+        "backlinks": [schemas.Note.model_validate(n) for n in backlinks],
+    }
+
+
+@app.post("/summarize/", tags=["AI"])
+async def summarize(content: Optional[str] = Body(None, embed=True), db: AsyncSession = Depends(get_db)):
+    if not content:
+        raise HTTPException(400, "Content must be provided")
+
+    # Summaries are a pure function of the content, so cache them by
+    # content hash (user-agnostic: duplicate notes share the entry).
+    cache_key = "sum:" + hashlib.blake2b(content.encode(), digest_size=16).hexdigest() + ":100:30"
+    cached = await redis_client.get(cache_key)
+    if cached:
+        return {"summary": cached.decode()}
+
+    def run_summarizer(text, max_length):
+        return get_summarizer()(text, max_length=max_length, min_length=30, do_sample=False)[0]["summary_text"]
+
+    def run_summarizer_batch(texts):
+        # One pipeline call for all chunks: the tokenizer pads them into a
+        # single batch instead of re-launching kernels per chunk.
+        outputs = get_summarizer()(
+            texts, max_length=100, min_length=30, do_sample=False,
+            batch_size=min(8, len(texts)),
+        )
+        return [o["summary_text"] for o in outputs]
+
+    chunks = chunk_text(content, 500)
+    partial = await run_in_threadpool(run_summarizer_batch, chunks)
+    final = " ".join(partial) if len(partial) == 1 else await run_in_threadpool(run_summarizer, " ".join(partial), 120)
+    await redis_client.set(cache_key, final, ex=86400)
+    return {"summary": final}
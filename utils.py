@@ -1,8 +1,12 @@
-import re
-
-def extract_note_links(content: str) -> list[str]:
-    return re.findall(r'\[\[([^\]]+)\]\]', content)
-
-def extract_links(content: str) -> list[str]:
-    # Find all [[Note Title]] style links
-    return re.findall(r"\[\[([^\]]+)\]\]", content)
\ No newline at end of file
+import re
+
+# Compiled once at import so the hot backlink paths skip the regex-cache
+# lookup on every call.
+_LINK_RE = re.compile(r"\[\[([^\]]+)\]\]")
+
+def extract_note_links(content: str) -> list[str]:
+    return _LINK_RE.findall(content)
+
+def extract_links(content: str) -> list[str]:
+    # Find all [[Note Title]] style links
+    return _LINK_RE.findall(content)